@@ -0,0 +1,139 @@
+import os
+import logging
+import multiprocessing
+import numpy as np
+import main
+import utils
+import corridors
+
+logger = logging.getLogger(os.path.basename(__file__))
+logger = utils.configure_logger(logger)
+
+
+def batch_orders(routing_cache, orders, capacity, depots):
+    """
+    Groups orders into tours that hold at most `capacity` books each.
+
+    Orders are first assigned to the zone of their nearest depot. Within a zone, a tour is seeded with the unbatched
+    order farthest from the depot and is then grown with the orders whose pick faces are closest to the pick faces
+    already in the tour, until no other order fits. Orders are never split across tours.
+
+    :param routing_cache: A RoutingCache or CorridorGraph for the warehouse the orders are picked in.
+    :param orders: A list of orders, each a list of Book instances.
+    :param capacity: The maximum number of books in a single tour.
+    :param depots: A list of navigable (r, c) cells where tours start and end.
+    :return: A list of (depot, books) tuples, one for each tour.
+    """
+    gt_library_warehouse = routing_cache.gt_library_warehouse
+    depots = [tuple(depot) for depot in depots]
+
+    orders_locations = []
+    for order in orders:
+        if len(order) > capacity:
+            raise ValueError('Order with %d books exceeds the tour capacity of %d.' % (len(order), capacity))
+
+        orders_locations.append(set(gt_library_warehouse.get_books_locations(order)))
+
+    logger.debug('Computing distance matrix on %d depots and pick faces.' % len(depots))
+    locations = depots + sorted(set.union(set(), *orders_locations) - set(depots))
+    locations_to_indices = {location: i for i, location in enumerate(locations)}
+    distance_matrix = routing_cache.get_distance_matrix(locations)
+
+    def get_distance_to_nearest(from_locations, to_locations):
+        """ Mean distance from each of the given locations to its nearest target location. """
+        to_indices = [locations_to_indices[location] for location in to_locations]
+        return np.mean([distance_matrix[locations_to_indices[location], to_indices].min()
+                        for location in from_locations])
+
+    zones = [(depot, []) for depot in depots]
+    for i, order_locations in enumerate(orders_locations):
+        _, zone_orders = min(zones, key=lambda zone: get_distance_to_nearest(order_locations, [zone[0]]))
+        zone_orders.append(i)
+
+    tours = []
+    for depot, unbatched in zones:
+        logger.debug('Batching %d orders for depot %s.' % (len(unbatched), depot))
+
+        while unbatched:
+            seed = max(unbatched, key=lambda i: get_distance_to_nearest(orders_locations[i], [depot]))
+            unbatched.remove(seed)
+
+            tour_orders = [seed]
+            tour_locations = set(orders_locations[seed])
+            tour_size = len(orders[seed])
+
+            while True:
+                candidates = [i for i in unbatched if tour_size + len(orders[i]) <= capacity]
+                if not candidates:
+                    break
+
+                nearest = min(candidates, key=lambda i: get_distance_to_nearest(orders_locations[i], tour_locations))
+                unbatched.remove(nearest)
+
+                tour_orders.append(nearest)
+                tour_locations |= orders_locations[nearest]
+                tour_size += len(orders[nearest])
+
+            tours.append((depot, [book for i in tour_orders for book in orders[i]]))
+
+    return tours
+
+
+def assign_tours_to_pickers(tour_costs, number_of_pickers):
+    """ Balances tours across pickers, longest tour first, always giving the next tour to the least loaded picker. """
+    picker_loads = [0] * number_of_pickers
+    picker_ids = [None] * len(tour_costs)
+
+    for i in sorted(range(len(tour_costs)), key=lambda i: -tour_costs[i]):
+        picker = int(np.argmin(picker_loads))
+        picker_ids[i] = picker + 1
+        picker_loads[picker] += tour_costs[i]
+
+    return picker_ids
+
+
+def get_batched_pick_paths(gt_library_warehouse, orders, capacity, depots, number_of_pickers=1,
+                           number_of_processes=None):
+    """
+    Batches the given orders into capacity-bound tours around the given depots, solves every tour (in parallel unless
+    `number_of_processes` is 1) and assigns the tours to pickers.
+
+    Each tour is solved exactly with Held-Karp, so `capacity` should stay small enough for that to be tractable.
+    """
+    # Batching needs the distances between all pick faces of all orders, which is where a corridor graph pays off
+    routing_cache = corridors.get_routing_cache(gt_library_warehouse, depots)
+
+    tours = batch_orders(routing_cache, orders, capacity, depots)
+    logger.info('Batched %d orders into %d tours.' % (len(orders), len(tours)))
+
+    if number_of_processes == 1:
+        pick_path_dicts = [main.generate_pick_path_as_dict_for_books(gt_library_warehouse, books, depot, routing_cache)
+                           for depot, books in tours]
+    else:
+        pool = multiprocessing.Pool(number_of_processes, main.initialize_tour_solver, (gt_library_warehouse,))
+        try:
+            pick_path_dicts = pool.map(main.solve_tour, tours)
+        finally:
+            pool.close()
+            pool.join()
+
+    tour_costs = []
+    for (depot, _), pick_path_dict in zip(tours, pick_path_dicts):
+        tour_locations = [depot] + [tuple(book_and_location['location'])
+                                    for book_and_location in pick_path_dict['orderedBooksAndLocations']] + [depot]
+        tour_costs.append(sum(routing_cache.get_distance(tour_locations[i], tour_locations[i + 1])
+                              for i in range(len(tour_locations) - 1)))
+
+    picker_ids = assign_tours_to_pickers(tour_costs, number_of_pickers)
+
+    pick_paths = []
+    for i, ((depot, _), pick_path_dict) in enumerate(zip(tours, pick_path_dicts)):
+        pick_paths.append({
+            'pathId': i + 1,
+            'pathType': 'batch',
+            'pickerId': picker_ids[i],
+            'depot': depot,
+            'pickPathInformation': pick_path_dict
+        })
+
+    return pick_paths
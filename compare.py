@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import multiprocessing
+import numpy as np
+import utils
+from main import PICK_PATH_FILE_FORMAT_VERSION
+
+logger = logging.getLogger(os.path.basename(__file__))
+logger = utils.configure_logger(logger, logging_level=logging.INFO)
+
+METRICS = ('tourCost', 'legCount', 'shortcutLength')
+
+SUMMARY_PERCENTILES = (50, 90, 99, 100)
+
+
+def load_pick_paths(file_path):
+    """ Loads a pick path file and returns its pick paths keyed by path ID. """
+    with open(file_path) as f:
+        pick_path_data = json.load(f)
+
+    assert pick_path_data['version'] == PICK_PATH_FILE_FORMAT_VERSION
+
+    return {pick_path['pathId']: pick_path for pick_path in pick_path_data['pickPaths']}
+
+
+def get_pick_path_metrics(pick_path):
+    """
+    Measures a pick path. The tour cost is the number of grid steps walked between books, the leg count is the number
+    of legs in the tour, and the shortcut length is the straight-line length of the shortcut legs.
+    """
+    ordered_pick_path = pick_path['pickPathInformation']['orderedPickPath']
+    number_of_books = len(pick_path['pickPathInformation']['orderedBooksAndLocations'])
+
+    tour_cost = 0
+    shortcut_length = 0.0
+
+    for path_component in ordered_pick_path:
+        cells = np.asarray(path_component['cellByCellPathToTargetBookLocation']).reshape(-1, 2)
+
+        # Every shortcut line is walked along the grid, one row or column at a time
+        tour_cost += int(np.abs(np.diff(cells, axis=0)).sum())
+        shortcut_length += utils.get_segment_lengths(cells).sum()
+
+    # Every book adds two extra steps (move to book cell, move away from book cell)
+    tour_cost -= number_of_books * 2
+
+    return {
+        'tourCost': tour_cost,
+        'legCount': len(ordered_pick_path),
+        'shortcutLength': shortcut_length,
+    }
+
+
+def get_book_tags(pick_path):
+    return sorted(book_and_location['book']['tag']
+                  for book_and_location in pick_path['pickPathInformation']['unorderedBooksAndLocations'])
+
+
+def compare_pick_paths(baseline_pick_paths, candidate_pick_paths, number_of_processes=None):
+    """
+    Compares the pick paths with the same ID in both files. Pick paths missing from either file, or whose books differ,
+    can't be compared and are only counted.
+    :return: The matched path IDs and, for each of them, the baseline and candidate metrics.
+    """
+    path_ids = sorted(set(baseline_pick_paths) & set(candidate_pick_paths))
+    path_ids = [path_id for path_id in path_ids
+                if get_book_tags(baseline_pick_paths[path_id]) == get_book_tags(candidate_pick_paths[path_id])]
+
+    pool = multiprocessing.Pool(number_of_processes)
+    try:
+        baseline_metrics = pool.map(get_pick_path_metrics, [baseline_pick_paths[path_id] for path_id in path_ids])
+        candidate_metrics = pool.map(get_pick_path_metrics, [candidate_pick_paths[path_id] for path_id in path_ids])
+    finally:
+        pool.close()
+        pool.join()
+
+    return path_ids, baseline_metrics, candidate_metrics
+
+
+def get_summary(baseline_pick_paths, candidate_pick_paths, path_ids, baseline_metrics, candidate_metrics):
+    """ Summarizes the totals of every metric and the percentiles of the per-path relative change of every metric. """
+    summary = {
+        'numberOfBaselinePickPaths': len(baseline_pick_paths),
+        'numberOfCandidatePickPaths': len(candidate_pick_paths),
+        'numberOfComparedPickPaths': len(path_ids),
+        'metrics': {},
+    }
+
+    for metric in METRICS:
+        baseline_values = np.array([metrics[metric] for metrics in baseline_metrics], dtype=float)
+        candidate_values = np.array([metrics[metric] for metrics in candidate_metrics], dtype=float)
+
+        relative_changes = (candidate_values - baseline_values) / np.maximum(baseline_values, 1.0)
+
+        summary['metrics'][metric] = {
+            'baselineTotal': baseline_values.sum(),
+            'candidateTotal': candidate_values.sum(),
+            'relativeChangePercentiles': {
+                'p%d' % percentile: np.percentile(relative_changes, percentile) if len(path_ids) else None
+                for percentile in SUMMARY_PERCENTILES
+            },
+        }
+
+    return summary
+
+
+def get_cost_regressions(path_ids, baseline_metrics, candidate_metrics, max_cost_regression):
+    """ Returns the IDs of the pick paths whose tour cost grew by more than the given fraction of the baseline cost. """
+    return [path_id for path_id, baseline, candidate in zip(path_ids, baseline_metrics, candidate_metrics)
+            if candidate['tourCost'] > baseline['tourCost'] * (1 + max_cost_regression)]
+
+
+def compare(arguments):
+    parser = argparse.ArgumentParser(description='Compares the quality of two pick path files with the same pick lists.')
+    parser.add_argument('baseline', help='The pick path file to compare against, e.g. pick-paths.json.')
+    parser.add_argument('candidate', help='The newly generated pick path file.')
+    parser.add_argument('--max-cost-regression', type=float, default=0.0,
+                        help='The fraction by which the tour cost of any pick path may grow (default: 0).')
+    parser.add_argument('--summary-file', default='pick-paths-comparison.json',
+                        help='Where to write the comparison summary (default: pick-paths-comparison.json).')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='The number of processes to measure pick paths with (default: all CPUs).')
+    arguments = parser.parse_args(arguments)
+
+    baseline_pick_paths = load_pick_paths(arguments.baseline)
+    candidate_pick_paths = load_pick_paths(arguments.candidate)
+
+    path_ids, baseline_metrics, candidate_metrics = compare_pick_paths(
+        baseline_pick_paths, candidate_pick_paths, arguments.processes)
+
+    summary = get_summary(baseline_pick_paths, candidate_pick_paths, path_ids, baseline_metrics, candidate_metrics)
+    summary['costRegressions'] = get_cost_regressions(
+        path_ids, baseline_metrics, candidate_metrics, arguments.max_cost_regression)
+
+    with open(arguments.summary_file, mode='w+') as f:
+        json.dump(summary, f, indent=4)
+
+    logger.info('Compared %d of %d pick paths.' % (len(path_ids), len(baseline_pick_paths)))
+    for metric in METRICS:
+        logger.info('%s: %.1f -> %.1f' % (metric, summary['metrics'][metric]['baselineTotal'],
+                                          summary['metrics'][metric]['candidateTotal']))
+
+    if not path_ids:
+        logger.error('No pick paths with the same books in both files could be compared.')
+        return 2
+
+    if summary['costRegressions']:
+        logger.error('Tour cost regressed by more than %.1f%% for pick paths %s.'
+                     % (arguments.max_cost_regression * 100, ', '.join(map(str, summary['costRegressions']))))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(compare(sys.argv[1:]))
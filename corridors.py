@@ -0,0 +1,216 @@
+import os
+import logging
+import networkx as nx
+import numpy as np
+import utils
+from routing import RoutingCache
+from constants import NAVIGABLE_CELL
+
+logger = logging.getLogger(os.path.basename(__file__))
+logger = utils.configure_logger(logger)
+
+# The largest fraction of navigable cells that may be left as junctions for distances on a corridor graph to pay off
+MAX_JUNCTION_FRACTION = 0.5
+
+
+class CorridorGraph(object):
+    """
+    A hierarchical view of a warehouse's navigation grid for routing. Runs of navigable cells that can only be walked
+    straight through (cells with exactly two navigable neighbors) are collapsed into single weighted corridor edges
+    between junction cells, so distances are searched on a graph that grows with the number of aisles rather than
+    with floor area.
+
+    Legs are still routed and shortcut by a RoutingCache on the cell graph. Among equally short paths, the shortcut
+    depends on which one is taken, so this keeps every leg identical to the one utils.get_pick_path_in_library routes.
+    Every pick face (the navigable cell next to a shelve) is a junction, as are any extra junctions given (e.g. depots).
+    Like a RoutingCache, a CorridorGraph can be passed to utils.get_subgraph_on_book_locations and
+    utils.get_pick_path_in_library as their routing cache.
+    """
+
+    def __init__(self, gt_library_warehouse, extra_junctions=(), routing_cache=None):
+        self.gt_library_warehouse = gt_library_warehouse
+        self.routing_cache = routing_cache if routing_cache is not None else RoutingCache(gt_library_warehouse)
+
+        pick_faces = [utils.get_navigable_cell_coordinate_near_book(location, gt_library_warehouse)
+                      for location in gt_library_warehouse.locations_to_shelve_tags]
+
+        self.junctions = set(cell for cell in pick_faces + [tuple(junction) for junction in extra_junctions]
+                             if self._is_navigable(cell))
+        for r in range(gt_library_warehouse.num_rows):
+            for c in range(gt_library_warehouse.num_cols):
+                if self._is_navigable((r, c)) and len(self._get_navigable_neighbors((r, c))) != 2:
+                    self.junctions.add((r, c))
+
+        # Every corridor is the list of cells from one junction to another, including both junctions
+        self.corridors = []
+
+        # Maps every cell inside a corridor to the index of its corridor and its position in that corridor
+        self.cells_to_corridors = {}
+
+        self.G_corridors = nx.Graph()
+        self.G_corridors.add_nodes_from(self.junctions)
+
+        for junction in self.junctions:
+            for neighbor in self._get_navigable_neighbors(junction):
+                if neighbor in self.cells_to_corridors or (neighbor in self.junctions and neighbor < junction):
+                    # This corridor was already walked from its other end
+                    continue
+
+                corridor = self._walk_corridor(junction, neighbor)
+                corridor_index = len(self.corridors)
+                self.corridors.append(corridor)
+
+                for position, cell in enumerate(corridor[1:-1], start=1):
+                    self.cells_to_corridors[cell] = corridor_index, position
+
+                start, end, weight = corridor[0], corridor[-1], len(corridor) - 1
+
+                # Keep only the shortest corridor between two junctions; corridors looping back are never shortest
+                if start != end and (not self.G_corridors.has_edge(start, end)
+                                     or self.G_corridors[start][end]['weight'] > weight):
+                    self.G_corridors.add_edge(start, end, weight=weight, corridor_index=corridor_index)
+
+        # Maps a junction to the shortest path distances and junction paths from it to every reachable junction
+        self.junction_rows = {}
+
+        logger.debug('Collapsed %d navigable cells into %d junctions and %d corridors.'
+                     % (len(self.junctions) + len(self.cells_to_corridors), self.G_corridors.number_of_nodes(),
+                        self.G_corridors.number_of_edges()))
+
+    def get_shortest_path(self, cell_a, cell_b):
+        """
+        Returns a shortest cell-by-cell path between two navigable cells and its length. When several paths are equally
+        short, this may not be the one nx.dijkstra_path takes on the cell graph.
+        """
+        cell_a, cell_b = tuple(cell_a), tuple(cell_b)
+
+        best_cost, best_path = np.inf, None
+
+        # Both cells may lie in the same corridor, in which case walking along it is a candidate too
+        if cell_a in self.cells_to_corridors and cell_b in self.cells_to_corridors:
+            corridor_index_a, position_a = self.cells_to_corridors[cell_a]
+            corridor_index_b, position_b = self.cells_to_corridors[cell_b]
+
+            if corridor_index_a == corridor_index_b:
+                best_cost = abs(position_a - position_b)
+                best_path = self._get_corridor_cells(corridor_index_a, position_a, position_b)
+
+        for junction_a, cost_a, path_a in self._get_exits(cell_a):
+            distances, junction_paths = self._get_junction_row(junction_a)
+
+            for junction_b, cost_b, path_b in self._get_exits(cell_b):
+                if junction_b not in distances:
+                    continue
+
+                cost = cost_a + distances[junction_b] + cost_b
+                if cost < best_cost:
+                    best_cost = cost
+                    best_path = path_a[:-1] + self._expand_junction_path(junction_paths[junction_b]) + path_b[::-1][1:]
+
+        if best_path is None:
+            raise nx.NetworkXNoPath('No path between %s and %s.' % (cell_a, cell_b))
+
+        return best_path, best_cost
+
+    def get_distance(self, location_a, location_b):
+        """ Returns the walking distance between two locations, each either a shelve or a navigable cell. """
+        _, cost = self.get_shortest_path(utils.get_navigable_cell_coordinate(location_a, self.gt_library_warehouse),
+                                         utils.get_navigable_cell_coordinate(location_b, self.gt_library_warehouse))
+        return cost
+
+    def get_distance_matrix(self, locations):
+        """ Returns the matrix of walking distances between every pair of the given locations. """
+        return np.array([[self.get_distance(a, b) for b in locations] for a in locations])
+
+    def get_leg(self, location_a, location_b):
+        """ Returns the shortcut cell-by-cell path between two locations, exactly as utils.get_leg_in_library. """
+        return self.routing_cache.get_leg(location_a, location_b)
+
+    def _get_junction_row(self, junction):
+        if junction not in self.junction_rows:
+            self.junction_rows[junction] = nx.single_source_dijkstra(self.G_corridors, junction)
+
+        return self.junction_rows[junction]
+
+    def _get_exits(self, cell):
+        """ Returns the junctions a cell can leave through, with the cost and cells from the cell to each junction. """
+        if cell in self.junctions:
+            return [(cell, 0, [cell])]
+
+        if cell not in self.cells_to_corridors:
+            raise nx.NetworkXNoPath('Cell %s is not connected to any junction.' % (cell,))
+
+        corridor_index, position = self.cells_to_corridors[cell]
+        corridor = self.corridors[corridor_index]
+
+        return [
+            (corridor[0], position, self._get_corridor_cells(corridor_index, position, 0)),
+            (corridor[-1], len(corridor) - 1 - position, self._get_corridor_cells(corridor_index, position, -1)),
+        ]
+
+    def _get_corridor_cells(self, corridor_index, from_position, to_position):
+        """ Returns the cells of a corridor from one position to another, both included. """
+        corridor = self.corridors[corridor_index]
+        to_position %= len(corridor)
+
+        if from_position <= to_position:
+            return corridor[from_position:to_position + 1]
+
+        return corridor[to_position:from_position + 1][::-1]
+
+    def _expand_junction_path(self, junction_path):
+        """ Expands a path of junctions into the cells of the corridors between them. """
+        cells = [junction_path[0]]
+
+        for u, v in zip(junction_path[:-1], junction_path[1:]):
+            corridor_index = self.G_corridors[u][v]['corridor_index']
+            corridor = self.corridors[corridor_index]
+
+            if corridor[0] == u:
+                cells += self._get_corridor_cells(corridor_index, 0, -1)[1:]
+            else:
+                cells += self._get_corridor_cells(corridor_index, len(corridor) - 1, 0)[1:]
+
+        return cells
+
+    def _walk_corridor(self, junction, neighbor):
+        """ Follows the cells from a junction through the given neighbor until the next junction. """
+        corridor = [junction]
+        previous_cell, cell = junction, neighbor
+
+        while cell not in self.junctions:
+            corridor.append(cell)
+            next_cells = [n for n in self._get_navigable_neighbors(cell) if n != previous_cell]
+            previous_cell, cell = cell, next_cells[0]
+
+        corridor.append(cell)
+
+        return corridor
+
+    def _is_navigable(self, cell):
+        r, c = cell
+        return 0 <= r < self.gt_library_warehouse.num_rows and 0 <= c < self.gt_library_warehouse.num_cols \
+            and self.gt_library_warehouse.get_cell(r, c) is NAVIGABLE_CELL
+
+    def _get_navigable_neighbors(self, cell):
+        r, c = cell
+        return [neighbor for neighbor in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1))
+                if self._is_navigable(neighbor)]
+
+
+def get_routing_cache(gt_library_warehouse, extra_junctions=()):
+    """
+    Returns a CorridorGraph for the warehouse if it collapses the navigation grid enough to pay off, and a plain
+    RoutingCache otherwise (e.g. on open floor plans, where almost every cell is a junction).
+    """
+    routing_cache = RoutingCache(gt_library_warehouse)
+    corridor_graph = CorridorGraph(gt_library_warehouse, extra_junctions, routing_cache)
+
+    number_of_junctions = corridor_graph.G_corridors.number_of_nodes()
+    number_of_cells = routing_cache.G_library.number_of_nodes()
+
+    if number_of_junctions > MAX_JUNCTION_FRACTION * number_of_cells:
+        logger.debug('Routing on navigable cells, as %d of %d are junctions.' % (number_of_junctions, number_of_cells))
+        return routing_cache
+
+    return corridor_graph
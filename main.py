@@ -1,7 +1,10 @@
 from models import GTLibraryGridWarehouse
+from routing import RoutingCache
+from tour_cache import TourCache, solve as solve_tsp
 import utils
-from tsp import held_karp as tsp_help_karp
 import numpy as np
+import collections
+import multiprocessing
 import json
 import logging
 import os
@@ -12,35 +15,58 @@ logger = utils.configure_logger(logger)
 
 PICK_PATH_FILE_FORMAT_VERSION = '1.2'
 
+# Per-process routing and tour caches used when tours are solved in a pool, set up once by initialize_tour_solver
+_worker_routing_cache = None
+_worker_tour_cache = None
 
-def generate_pick_path_as_dict(gt_library_warehouse, books_per_pick_path, source):  # type: (GTLibraryGridWarehouse, int, (int, int)) -> dict
 
+def generate_pick_path_as_dict(gt_library_warehouse, books_per_pick_path, source, routing_cache=None, tour_cache=None):  # type: (GTLibraryGridWarehouse, int, (int, int), RoutingCache, TourCache) -> dict
+
+    unordered_books = choose_books_at_random(gt_library_warehouse, books_per_pick_path)
+
+    return generate_pick_path_as_dict_for_books(
+        gt_library_warehouse, unordered_books, source, routing_cache, tour_cache)
+
+
+def choose_books_at_random(gt_library_warehouse, books_per_pick_path):
     logger.debug('Choosing %d books at random.' % books_per_pick_path)
-    unordered_books = np.random.choice(
+    return np.random.choice(
         a=gt_library_warehouse.books,
         size=books_per_pick_path,
         replace=False,
     )
 
+
+def generate_pick_path_as_dict_for_books(gt_library_warehouse, unordered_books, source, routing_cache=None,
+                                         tour_cache=None):
+    """
+    Solves and routes a single tour that starts and ends at the source and picks every one of the given books.
+    With a tour cache, the tour may be warm-started from a similar cached tour and is then not necessarily optimal.
+    """
+
     unordered_books_locations = gt_library_warehouse.get_books_locations(unordered_books)
 
-    logger.debug('Getting sub-graph on chosen book locations and source for TSP.')
-    # If two books are on the same column, this method will consider them the same cell,
+    # Books on the same column share a pick face, which is solved and routed once,
     # This is why we'll need reintroduce_duplicate_column_locations later
-    G_subgraph = utils.get_subgraph_on_book_locations(gt_library_warehouse, unordered_books_locations, source)
+    books_by_pick_face = utils.get_books_by_pick_face(unordered_books, unordered_books_locations)
+
+    logger.debug('Getting sub-graph on %d pick faces and source for TSP.' % len(books_by_pick_face))
+    G_subgraph = utils.get_subgraph_on_book_locations(
+        gt_library_warehouse, list(books_by_pick_face), source, routing_cache=routing_cache)
 
     logger.debug('Solving TSP for selected books.')
-    optimal_pick_path, optimal_cost = tsp_help_karp.solver(G_subgraph, source)
+    optimal_pick_path, optimal_cost = solve_tsp(G_subgraph, source, tour_cache)
 
     logger.debug('Patching up solution.')
     ordered_books, ordered_locations = utils.reintroduce_duplicate_column_locations(
-        zip(unordered_books, unordered_books_locations), source, optimal_pick_path)
+        books_by_pick_face, source, optimal_pick_path)
 
     # The optimal pick path has two more source locations (source, ..., source)
     assert len(unordered_books) == len(ordered_books) - 2 == len(ordered_locations) - 2
 
     logger.debug('Computing cell-by-cell pick path in library based on TSP solution.')
-    optimal_pick_path_in_library = utils.get_pick_path_in_library(gt_library_warehouse, ordered_locations, source)
+    optimal_pick_path_in_library = utils.get_pick_path_in_library(
+        gt_library_warehouse, ordered_locations, source, routing_cache=routing_cache)
 
     logger.debug('Verifying solution has right format and cost.')
     utils.assert_library_pick_path_is_proper(optimal_pick_path_in_library, ordered_locations, source)
@@ -51,44 +77,141 @@ def generate_pick_path_as_dict(gt_library_warehouse, books_per_pick_path, source
         unordered_books, unordered_books_locations, ordered_books, ordered_locations, optimal_pick_path_in_library)
 
 
-def get_pick_paths(number_of_training_pick_paths, number_of_testing_pick_paths, books_per_pick_path, source):
+def initialize_tour_solver(gt_library_warehouse, use_tour_cache=False):
+    """ Sets up a pool worker process with its own routing cache, and optionally tour cache, for solve_tour. """
+    global _worker_routing_cache, _worker_tour_cache
+    _worker_routing_cache = RoutingCache(gt_library_warehouse)
+    _worker_tour_cache = TourCache() if use_tour_cache else None
+
+
+def solve_tour(source_and_books):
+    """ Solves a single (source, books) tour in a pool worker process set up by initialize_tour_solver. """
+    source, books = source_and_books
+    return generate_pick_path_as_dict_for_books(
+        _worker_routing_cache.gt_library_warehouse, books, source, _worker_routing_cache, _worker_tour_cache)
+
+
+def iter_pick_paths(number_of_training_pick_paths, number_of_testing_pick_paths, books_per_pick_path, source,
+                    number_of_processes=1, max_pick_paths_in_flight=8):
+    """
+    Lazily generates pick paths in order. Books for a pick path are only chosen once there is room to solve it, and at
+    most `max_pick_paths_in_flight` pick paths are being solved or waiting to be consumed at a time, so memory stays
+    flat however many pick paths are generated. With more than one process, pick paths are solved in a pool.
+    """
     # East-side of library is top of array
     gt_library_warehouse = utils.get_warehouse('warehouse.json')
 
-    pick_paths = []
-
-    for i in range(number_of_training_pick_paths + number_of_testing_pick_paths):
-        logger.info("Processing path #%s" % (i + 1,))
+    number_of_pick_paths = number_of_training_pick_paths + number_of_testing_pick_paths
 
-        pick_path_as_dict = generate_pick_path_as_dict(gt_library_warehouse, books_per_pick_path, source)
+    if number_of_processes == 1:
+        routing_cache = RoutingCache(gt_library_warehouse)
+        pick_path_dicts = (generate_pick_path_as_dict(gt_library_warehouse, books_per_pick_path, source, routing_cache)
+                           for _ in range(number_of_pick_paths))
+    else:
+        tours = ((source, choose_books_at_random(gt_library_warehouse, books_per_pick_path))
+                 for _ in range(number_of_pick_paths))
+        pick_path_dicts = _iter_tours_solved_in_pool(
+            gt_library_warehouse, tours, number_of_processes, max_pick_paths_in_flight)
 
-        pick_paths.append({
+    for i, pick_path_as_dict in enumerate(pick_path_dicts):
+        yield {
             'pathId': i + 1,
             'pathType': 'training' if i < number_of_training_pick_paths else 'testing',
             'pickPathInformation': pick_path_as_dict
-        })
+        }
 
         logger.info("Completed path #%s" % (i + 1,))
 
-    return pick_paths
+
+def _iter_tours_solved_in_pool(gt_library_warehouse, tours, number_of_processes, max_tours_in_flight):
+    """ Solves the tours in a pool and yields the results in order, never submitting more tours than allowed. """
+    pool = multiprocessing.Pool(number_of_processes, initialize_tour_solver, (gt_library_warehouse,))
+
+    try:
+        tours_in_flight = collections.deque()
+
+        for tour in tours:
+            if len(tours_in_flight) == max_tours_in_flight:
+                yield tours_in_flight.popleft().get()
+
+            tours_in_flight.append(pool.apply_async(solve_tour, (tour,)))
+
+        while tours_in_flight:
+            yield tours_in_flight.popleft().get()
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_pick_paths(number_of_training_pick_paths, number_of_testing_pick_paths, books_per_pick_path, source):
+    return list(iter_pick_paths(
+        number_of_training_pick_paths, number_of_testing_pick_paths, books_per_pick_path, source))
+
+
+def write_pick_paths(pick_paths, file_path):
+    """
+    Writes pick paths to a pick path file one at a time as they are consumed, so the whole file never has to be held in
+    memory. Returns the number of pick paths written.
+
+    The pick paths are streamed to a temporary file next to the target, which only replaces the target once every pick
+    path has been written, so a failure while generating them leaves any existing file untouched.
+    """
+    number_of_pick_paths = 0
+
+    temporary_file_path = os.path.join(os.path.dirname(os.path.abspath(file_path)),
+                                       '.%s.%d.tmp' % (os.path.basename(file_path), os.getpid()))
+
+    try:
+        with open(temporary_file_path, mode='w+') as f:
+            f.write('{\n    "pickPaths": [')
+
+            for pick_path in pick_paths:
+                if number_of_pick_paths > 0:
+                    f.write(', ')
+
+                # Indent every line of the pick path to its depth in the file
+                f.write('\n' + '\n'.join(' ' * 8 + line for line in json.dumps(pick_path, indent=4).split('\n')))
+
+                number_of_pick_paths += 1
+
+            if number_of_pick_paths > 0:
+                f.write('\n    ')
+
+            f.write('], \n    "version": %s\n}' % json.dumps(PICK_PATH_FILE_FORMAT_VERSION))
+
+        os.rename(temporary_file_path, file_path)
+
+    except BaseException:
+        if os.path.exists(temporary_file_path):
+            os.remove(temporary_file_path)
+        raise
+
+    return number_of_pick_paths
 
 
 if __name__ == '__main__':
     np.random.seed(1)
 
-    pick_paths = get_pick_paths(
+    number_of_processes = 1
+
+    pick_paths = iter_pick_paths(
         number_of_training_pick_paths=20,
         number_of_testing_pick_paths=20,
         books_per_pick_path=10,
         source=(0, 0),
+        number_of_processes=number_of_processes,
+        max_pick_paths_in_flight=8,
     )
 
-    with open('pick-paths.json', mode='w+') as f:
-        json.dump(
-            obj={
-                'version': PICK_PATH_FILE_FORMAT_VERSION,
-                'pickPaths': pick_paths
-            },
-            fp=f,
-            indent=4,
-        )
+    number_of_pick_paths = write_pick_paths(pick_paths, 'pick-paths.json')
+
+    peak_memory_usage_mb, peak_worker_memory_usage_mb = utils.get_peak_memory_usage_mb()
+
+    # Pick paths are only solved in worker processes when there is more than one process
+    if number_of_processes == 1:
+        logger.info('Wrote %d pick paths. Peak memory usage was %.1f MB.'
+                    % (number_of_pick_paths, peak_memory_usage_mb))
+    else:
+        logger.info('Wrote %d pick paths. Peak memory usage was %.1f MB in this process and %.1f MB in a worker.'
+                    % (number_of_pick_paths, peak_memory_usage_mb, peak_worker_memory_usage_mb))
@@ -2,7 +2,6 @@ from constants import SHELVE_CELL, OBSTACLE_CELL, NAVIGABLE_CELL
 import copy
 import numpy as np
 from constants import SUBJECT_RADIUS
-import itertools
 
 
 class Book(object):
@@ -119,23 +118,27 @@ class GTLibraryGridWarehouse(object):
         if location_a == location_b:
             return True
 
-        import utils
+        for r, c in self.get_cells_near_segment(location_a, location_b, radius):
+            if self.get_cell(r, c) is not NAVIGABLE_CELL:
+                return False
 
-        path_line = location_a, location_b
+        return True
 
-        cell_border_offsets = list(itertools.product((-1, 0, +1), repeat=2))
+    def get_cells_near_segment(self, location_a, location_b, radius=SUBJECT_RADIUS):
+        """ Returns the cells whose centers are within the radius of the line segment between the two locations. """
 
-        for r in range(self.num_rows):
-            for c in range(self.num_cols):
-                for offset_r, offset_c in cell_border_offsets:
+        import utils
 
-                    new_r, new_c = r + offset_r, c + offset_c
+        # Only cells in the segment's bounding box, grown by the radius, can be close enough to the segment
+        margin = int(np.ceil(radius))
+        min_r = max(0, min(location_a[0], location_b[0]) - margin)
+        max_r = min(self.num_rows - 1, max(location_a[0], location_b[0]) + margin)
+        min_c = max(0, min(location_a[1], location_b[1]) - margin)
+        max_c = min(self.num_cols - 1, max(location_a[1], location_b[1]) + margin)
 
-                    if new_r < 0 or new_r >= self.num_rows or new_c < 0 or new_c >= self.num_cols:
-                        continue
+        rows, cols = np.mgrid[min_r:max_r + 1, min_c:max_c + 1]
+        cells = np.column_stack((rows.ravel(), cols.ravel()))
 
-                    if utils.minimumDistance(path_line, (new_r, new_c)) <= radius:
-                        if self.get_cell(new_r, new_c) is not NAVIGABLE_CELL:
-                            return False
+        distances = utils.get_minimum_distances([(location_a, location_b)], cells)[0]
 
-        return True
+        return [tuple(cell) for cell in cells[distances <= radius].tolist()]
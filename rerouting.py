@@ -0,0 +1,118 @@
+import os
+import time
+import logging
+import utils
+
+logger = logging.getLogger(os.path.basename(__file__))
+logger = utils.configure_logger(logger)
+
+ADD_BOOK = 'add'
+CANCEL_BOOK = 'cancel'
+OUT_OF_STOCK_BOOK = 'outOfStock'
+
+
+def reroute_pick_path(routing_cache, current_position, remaining_books, edit, source, max_seconds=0.01):
+    """
+    Repairs the rest of a tour after its pick list changed mid-tour, without re-solving the TSP from scratch.
+
+    An added book is put where it lengthens the remaining tour the least, a cancelled or out-of-stock book is simply
+    dropped, and the result is then improved with 2-opt moves on the cached distance matrix. Legs already in the routing
+    cache are reused, and legs that aren't (e.g. the one from the picker's current position) are shortcut only while
+    time is left. Once `max_seconds` have passed since the call, 2-opt stops and the remaining uncached legs are walked
+    cell by cell without shortcuts, so the only work not bounded by the budget is finding shortest paths on the grid.
+
+    :param routing_cache: A RoutingCache for the warehouse the picker is in.
+    :param current_position: The navigable (r, c) cell the picker is standing on.
+    :param remaining_books: The books still to be picked, in their currently planned order.
+    :param edit: An (action, book) tuple, where action is one of ADD_BOOK, CANCEL_BOOK or OUT_OF_STOCK_BOOK.
+    :param source: The navigable (r, c) cell the tour ends at.
+    :param max_seconds: The time budget for the local search and for shortcutting legs that aren't cached yet.
+    :return: A pick path dictionary, as in utils.get_pick_path_as_dict, starting at the current position.
+    """
+    started_at = time.time()
+    deadline = started_at + max_seconds
+
+    gt_library_warehouse = routing_cache.gt_library_warehouse
+    current_position, source = tuple(current_position), tuple(source)
+
+    books = list(remaining_books)
+    locations = gt_library_warehouse.get_books_locations(books)
+
+    action, book = edit
+    if action == ADD_BOOK:
+        if book in books:
+            raise ValueError('Book with tag %s is already in the remaining pick list.' % book.tag)
+
+        location = gt_library_warehouse.get_book_location(book)
+        index = get_cheapest_insertion_index(
+            routing_cache.get_distance, [current_position] + locations + [source], location)
+        books.insert(index, book)
+        locations.insert(index, location)
+
+    elif action in (CANCEL_BOOK, OUT_OF_STOCK_BOOK):
+        if book not in books:
+            raise ValueError("Book with tag %s isn't in the remaining pick list." % book.tag)
+
+        index = books.index(book)
+        del books[index]
+        del locations[index]
+
+    else:
+        raise ValueError('Unknown pick list edit %s.' % action)
+
+    distance_matrix = routing_cache.get_distance_matrix([current_position] + locations + [source])
+    order = improve_path_with_two_opt(distance_matrix, max(deadline - time.time(), 0))
+
+    ordered_books = (None,) + tuple(books[i] for i in order) + (None,)
+    ordered_locations = (current_position,) + tuple(locations[i] for i in order) + (source,)
+
+    pick_path_in_library = []
+    for n1, n2 in zip(ordered_locations[:-1], ordered_locations[1:]):
+        if n1 == n2:
+            pick_path_in_library.append(utils.get_zero_length_leg_in_library(gt_library_warehouse, n1))
+        else:
+            pick_path_in_library.append(routing_cache.get_leg(n1, n2, deadline=deadline))
+
+    logger.debug('Rerouted %d remaining books in %.1f ms.' % (len(books), (time.time() - started_at) * 1000))
+
+    return utils.get_pick_path_as_dict(books, locations, ordered_books, ordered_locations, pick_path_in_library)
+
+
+def get_cheapest_insertion_index(get_distance, path_locations, location):
+    """ Returns the index among the stops (excluding the path's start) where inserting the location costs the least. """
+    def get_insertion_cost(i):
+        return get_distance(path_locations[i], location) \
+            + get_distance(location, path_locations[i + 1]) \
+            - get_distance(path_locations[i], path_locations[i + 1])
+
+    return min(range(len(path_locations) - 1), key=get_insertion_cost)
+
+
+def improve_path_with_two_opt(distance_matrix, max_seconds=float('inf')):
+    """
+    Improves a path with fixed endpoints by reversing sub-sequences of its stops until no reversal shortens the path or
+    `max_seconds` pass. The path visits the rows of the distance matrix in order, and a tour that returns to its start
+    simply repeats the start as its last row. Returns the new order of the stops as indices into rows 1 to n - 2.
+    """
+    deadline = time.time() + max_seconds
+
+    # Index 0 and the last index are the fixed start and end of the path
+    path = list(range(len(distance_matrix)))
+
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+
+        for i in range(1, len(path) - 2):
+            for j in range(i + 1, len(path) - 1):
+                delta = distance_matrix[path[i - 1], path[j]] + distance_matrix[path[i], path[j + 1]] \
+                    - distance_matrix[path[i - 1], path[i]] - distance_matrix[path[j], path[j + 1]]
+
+                if delta < 0:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    improved = True
+
+            if time.time() >= deadline:
+                break
+
+    return [i - 1 for i in path[1:-1]]
@@ -0,0 +1,439 @@
+import os
+import copy
+import logging
+import time
+import collections
+import networkx as nx
+import numpy as np
+import utils
+from constants import NAVIGABLE_CELL, OBSTACLE_CELL, SUBJECT_RADIUS
+
+logger = logging.getLogger(os.path.basename(__file__))
+logger = utils.configure_logger(logger)
+
+
+class RoutingCache(object):
+    """
+    Keeps the navigation graph of a warehouse in memory along with single-source shortest path distances, routed legs
+    and clear shot checks, so that repeated queries don't rebuild the graph or re-run Dijkstra's algorithm.
+
+    Cells can be blocked and unblocked at runtime. Every cached leg and clear shot is indexed by the cells it depends
+    on, so a change to one cell only drops the cached results that the change can actually affect.
+    """
+
+    def __init__(self, gt_library_warehouse):
+        self.gt_library_warehouse = gt_library_warehouse
+
+        logger.debug('Building navigation graph for routing cache.')
+        self._G_library = utils.convert_grid_to_graph(gt_library_warehouse.navigation_grid)
+
+        # Set when a cell is blocked or unblocked, so the graph is rebuilt from the grid on its next use
+        self._is_graph_stale = False
+
+        # Maps a navigable cell to the shortest path distances from that cell to every reachable navigable cell
+        self.distance_rows = {}
+
+        # Maps a navigable cell to the cell before every reachable navigable cell on the shortest path from that cell,
+        # breaking ties exactly as nx.dijkstra_path does on a graph built from the current grid. Dropped along with the
+        # distance row, or on its own when a change to the grid may break a tie differently
+        self.predecessor_rows = {}
+
+        # Maps a pair of locations to the shortcut cell-by-cell path between them
+        self.legs = {}
+
+        # Maps a pair of locations to its cell-by-cell path, the cells it depends on, its first navigable cell, and its
+        # bounding box (grown by the subject's radius)
+        self.legs_details = {}
+
+        # Legs whose first cell's shortest path tree was dropped since they were routed, which are checked against the
+        # new tree on their next use
+        self.unverified_legs = set()
+
+        # Maps a pair of locations to whether the line between them is a clear shot, and to the cells near that line
+        self.clear_shots = {}
+        self.clear_shots_cells = {}
+
+        # Spatial indices from a cell to the cached legs and clear shots whose result depends on that cell
+        self.cells_to_legs = collections.defaultdict(set)
+        self.first_cells_to_legs = collections.defaultdict(set)
+        self.cells_to_clear_shots = collections.defaultdict(set)
+
+        # Cells blocked at runtime, which are the only ones that may be unblocked again
+        self.blocked_cells = set()
+
+    @property
+    def G_library(self):
+        """ The navigation graph of the warehouse as it is now, rebuilt from the grid if cells changed since. """
+        if self._is_graph_stale:
+            self._rebuild_graph()
+
+        return self._G_library
+
+    def get_distance_row(self, cell):
+        """ Returns the shortest path distances from the given navigable cell, computing them on first use. """
+        if cell not in self.distance_rows:
+            self._route_from_cell(cell)
+
+        return self.distance_rows[cell]
+
+    def get_distance(self, location_a, location_b):
+        """ Returns the walking distance between two locations, each either a shelve or a navigable cell. """
+        cell_a = utils.get_navigable_cell_coordinate(location_a, self.gt_library_warehouse)
+        cell_b = utils.get_navigable_cell_coordinate(location_b, self.gt_library_warehouse)
+
+        if cell_a not in self.distance_rows and cell_b in self.distance_rows:
+            # The navigation graph is undirected, so the row of either cell will do
+            cell_a, cell_b = cell_b, cell_a
+
+        distance_row = self.get_distance_row(cell_a)
+
+        if cell_b not in distance_row:
+            raise nx.NetworkXNoPath('No path between %s and %s.' % (location_a, location_b))
+
+        return distance_row[cell_b]
+
+    def get_distance_matrix(self, locations):
+        """ Returns the matrix of walking distances between every pair of the given locations. """
+        return np.array([[self.get_distance(a, b) for b in locations] for a in locations])
+
+    def get_leg(self, location_a, location_b, deadline=None):
+        """
+        Returns the shortcut cell-by-cell path between two locations, routing it on first use.
+
+        With a deadline (a time.time() value), a leg that is not cached yet avoids running Dijkstra's algorithm from
+        its first cell when the last cell's shortest path tree is cached, and is only shortcut until the deadline. Such
+        a leg is just as long to walk but may differ from the leg routed without a deadline, so it isn't cached.
+        """
+        key = tuple(location_a), tuple(location_b)
+
+        if key in self.unverified_legs and (deadline is None or self.legs_details[key][2] in self.predecessor_rows):
+            # The leg stays valid if the new shortest path tree still gives the same cells
+            path, _ = self._get_cell_by_cell_leg(*key)
+
+            if path == self.legs_details[key][0]:
+                self.unverified_legs.remove(key)
+            else:
+                self._forget_leg(key)
+
+        if key not in self.legs or key in self.unverified_legs:
+            path, is_canonical = self._get_cell_by_cell_leg(key[0], key[1], may_walk_back=deadline is not None)
+            shortcut_path = utils.shortcut_paths(self.gt_library_warehouse, path, routing_cache=self, deadline=deadline)
+
+            if not is_canonical or (deadline is not None and time.time() >= deadline) or key in self.legs:
+                return shortcut_path
+
+            # A leg depends on the cells it walks through and the cells near the clear shots its shortcut relies on
+            cells = set(path)
+            for clear_shot in self._get_shortcut_clear_shots(path, shortcut_path):
+                cells.update(self.gt_library_warehouse.get_cells_near_segment(*clear_shot))
+
+            margin = int(np.ceil(SUBJECT_RADIUS))
+            rows, cols = zip(*path)
+            bounding_box = min(rows) - margin, min(cols) - margin, max(rows) + margin, max(cols) + margin
+
+            first_cell = utils.get_navigable_cell_coordinate(key[0], self.gt_library_warehouse)
+
+            self.legs[key] = shortcut_path
+            self.legs_details[key] = path, cells, first_cell, bounding_box
+            for cell in cells:
+                self.cells_to_legs[cell].add(key)
+            self.first_cells_to_legs[first_cell].add(key)
+
+        return list(self.legs[key])
+
+    def is_clear_shot(self, location_a, location_b):
+        """ Returns whether the line between two locations is a clear shot, checking it on first use. """
+        key = tuple(location_a), tuple(location_b)
+
+        if key not in self.clear_shots:
+            self.clear_shots[key] = self.gt_library_warehouse.is_clear_shot(*key)
+            self.clear_shots_cells[key] = self.gt_library_warehouse.get_cells_near_segment(*key)
+
+            for cell in self.clear_shots_cells[key]:
+                self.cells_to_clear_shots[cell].add(key)
+
+        return self.clear_shots[key]
+
+    def block_cell(self, cell):
+        """ Marks a navigable cell as blocked (e.g. by a cart) and drops the cached routing that went through it. """
+        cell = tuple(cell)
+
+        if self.gt_library_warehouse.get_cell(*cell) is not NAVIGABLE_CELL:
+            raise ValueError('Only navigable cells can be blocked, %s is not navigable.' % (cell,))
+
+        neighbors = self._get_navigable_neighbors(cell)
+
+        self.gt_library_warehouse.navigation_grid[cell[0]][cell[1]] = OBSTACLE_CELL
+        self._is_graph_stale = True
+        self.blocked_cells.add(cell)
+
+        for source_cell in list(self.distance_rows):
+            distance_row = self.distance_rows[source_cell]
+
+            if source_cell == cell:
+                self._forget_row(source_cell)
+
+            elif cell in distance_row:
+                if self._has_neighbor_only_reached_through(distance_row, cell, neighbors):
+                    self._forget_row(source_cell)
+                    continue
+
+                del distance_row[cell]
+
+                predecessor_row = self.predecessor_rows.get(source_cell)
+                if predecessor_row is None:
+                    continue
+
+                # Dijkstra's algorithm never pushes anything when it visits a leaf of the tree, so taking a leaf out
+                # leaves every other tie broken the same way
+                if any(predecessor_row.get(neighbor) == cell for neighbor in neighbors):
+                    self._forget_predecessor_row(source_cell)
+                else:
+                    del predecessor_row[cell]
+
+        for key in list(self.cells_to_legs.get(cell, ())):
+            self._forget_leg(key)
+
+        for key in list(self.cells_to_clear_shots.get(cell, ())):
+            self._forget_clear_shot(key)
+
+        logger.debug('Blocked cell %s.' % (cell,))
+
+    def unblock_cell(self, cell):
+        """ Marks a previously blocked cell as navigable again and drops the cached routing it could shorten. """
+        cell = tuple(cell)
+
+        if cell not in self.blocked_cells:
+            raise ValueError('Cell %s was not blocked at runtime.' % (cell,))
+
+        self.gt_library_warehouse.navigation_grid[cell[0]][cell[1]] = NAVIGABLE_CELL
+        self._is_graph_stale = True
+        self.blocked_cells.remove(cell)
+
+        r, c = cell
+        neighbors = self._get_navigable_neighbors(cell)
+
+        # Only the rows that still exist are checked. Legs whose row is gone were marked unverified when it was dropped,
+        # and get checked against a new shortest path tree on their next use
+        for source_cell in list(self.distance_rows):
+            distance_row = self.distance_rows[source_cell]
+            neighbor_distances = [distance_row[neighbor] for neighbor in neighbors if neighbor in distance_row]
+
+            if not neighbor_distances:
+                continue
+
+            # The cell only shortens paths if it connects neighbors more than two steps apart (or not connected at all)
+            if len(neighbor_distances) < len(neighbors) or max(neighbor_distances) - min(neighbor_distances) > 2:
+                self._forget_row(source_cell)
+                continue
+
+            distance = distance_row[cell] = min(neighbor_distances) + 1
+
+            predecessor_row = self.predecessor_rows.get(source_cell)
+            if predecessor_row is None:
+                continue
+
+            # The cell comes in as a leaf of the tree if nothing is one step further than it, and its predecessor is
+            # only known without running Dijkstra's algorithm if a single neighbor is one step closer
+            parents = [neighbor for neighbor in neighbors if distance_row[neighbor] == distance - 1]
+            if len(parents) == 1 and distance + 1 not in neighbor_distances:
+                predecessor_row[cell] = parents[0]
+            else:
+                self._forget_predecessor_row(source_cell)
+
+        for key, (_, _, _, bounding_box) in list(self.legs_details.items()):
+            min_r, min_c, max_r, max_c = bounding_box
+
+            # A shortcut line can only become clear if the cell is near the leg
+            if min_r <= r <= max_r and min_c <= c <= max_c:
+                self._forget_leg(key)
+
+        for key in list(self.cells_to_clear_shots.get(cell, ())):
+            self._forget_clear_shot(key)
+
+        logger.debug('Unblocked cell %s.' % (cell,))
+
+    def _has_neighbor_only_reached_through(self, distance_row, cell, neighbors):
+        """
+        Returns whether one of the (blocked) cell's neighbors has the cell as its only predecessor on shortest paths
+        from the distance row's source. Only neighbors one step further than the cell can reach the source through it,
+        and as long as each of them has another neighbor as close as the cell, no distance changes.
+        """
+        distance = distance_row[cell]
+
+        for neighbor in neighbors:
+            if distance_row.get(neighbor) != distance + 1:
+                continue
+
+            if not any(distance_row.get(other) == distance
+                       for other in self._get_navigable_neighbors(neighbor) if other != cell):
+                return True
+
+        return False
+
+    def _get_navigable_neighbors(self, cell):
+        r, c = cell
+        return [neighbor for neighbor in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1))
+                if 0 <= neighbor[0] < self.gt_library_warehouse.num_rows
+                and 0 <= neighbor[1] < self.gt_library_warehouse.num_cols
+                and self.gt_library_warehouse.get_cell(*neighbor) is NAVIGABLE_CELL]
+
+    def _rebuild_graph(self):
+        """
+        Rebuilds the navigation graph from the grid, exactly as a new routing cache would. Rebuilding (rather than
+        adding and removing nodes) keeps every cell's neighbors in the order Dijkstra's algorithm breaks ties by.
+        """
+        logger.debug('Rebuilding navigation graph for routing cache.')
+
+        G_old, self._G_library = self._G_library, utils.convert_grid_to_graph(self.gt_library_warehouse.navigation_grid)
+        self._is_graph_stale = False
+
+        # The cached trees only break ties the same way if the cells they share still list their neighbors in order
+        for cell in self._G_library.nodes:
+            if cell in G_old and [neighbor for neighbor in G_old.successors(cell) if neighbor in self._G_library] != \
+                    [neighbor for neighbor in self._G_library.successors(cell) if neighbor in G_old]:
+                for source_cell in list(self.predecessor_rows):
+                    self._forget_predecessor_row(source_cell)
+                break
+
+    def _route_from_cell(self, cell):
+        predecessors, self.distance_rows[cell] = nx.dijkstra_predecessor_and_distance(self.G_library, cell)
+
+        # The first predecessor found is the one nx.dijkstra_path's path goes through
+        self.predecessor_rows[cell] = {v: predecessor[0] for v, predecessor in predecessors.items() if predecessor}
+
+    def _get_cell_by_cell_leg(self, location_a, location_b, may_walk_back=False):
+        """
+        Returns the same path as utils.get_cell_by_cell_leg_in_library, but follows the cached shortest path tree of the
+        first cell instead of running Dijkstra's algorithm for every leg. If allowed to walk back and only the last
+        cell's tree is cached, follows that tree from the first cell instead, which is a shortest path too but not
+        necessarily the same one.
+        :return: The path, and whether it is the same path utils.get_cell_by_cell_leg_in_library returns.
+        """
+        c1 = utils.get_navigable_cell_coordinate(location_a, self.gt_library_warehouse)
+        c2 = utils.get_navigable_cell_coordinate(location_b, self.gt_library_warehouse)
+
+        is_canonical = not (may_walk_back and c1 not in self.predecessor_rows and c2 in self.predecessor_rows)
+
+        root, cell = (c1, c2) if is_canonical else (c2, c1)
+
+        if root not in self.predecessor_rows:
+            self._route_from_cell(root)
+
+        if cell not in self.distance_rows[root]:
+            raise nx.NetworkXNoPath('No path between %s and %s.' % (location_a, location_b))
+
+        predecessor_row = self.predecessor_rows[root]
+
+        path = [cell]
+        while path[-1] != root:
+            path.append(predecessor_row[path[-1]])
+
+        if is_canonical:
+            path.reverse()
+
+        if c1 != location_a:
+            path = [location_a] + path
+
+        if c2 != location_b:
+            path = path + [location_b]
+
+        return path, is_canonical
+
+    @staticmethod
+    def _get_shortcut_clear_shots(path, shortcut_path):
+        """
+        Returns the clear shots utils.shortcut_paths picked for the path, i.e. from each cell it shortcut from to the
+        farthest cell that cell could see.
+        """
+        navigable_path = path[1:-1]
+
+        clear_shots = []
+
+        i = 0
+        for farthest_clear_shot_cell in shortcut_path[2:-1]:
+            farthest_clear_shot_index = navigable_path.index(farthest_clear_shot_cell, i)
+            clear_shots.append((navigable_path[i], farthest_clear_shot_cell))
+            i = farthest_clear_shot_index + 1
+
+        return clear_shots
+
+    def _forget_row(self, source_cell):
+        del self.distance_rows[source_cell]
+
+        if source_cell in self.predecessor_rows:
+            self._forget_predecessor_row(source_cell)
+
+    def _forget_predecessor_row(self, source_cell):
+        del self.predecessor_rows[source_cell]
+
+        # The legs routed on this tree may come out differently on the next one
+        self.unverified_legs.update(self.first_cells_to_legs.get(source_cell, ()))
+
+    def _forget_leg(self, key):
+        _, cells, first_cell, _ = self.legs_details.pop(key)
+        del self.legs[key]
+        self.unverified_legs.discard(key)
+
+        for cell in cells:
+            self.cells_to_legs[cell].discard(key)
+        self.first_cells_to_legs[first_cell].discard(key)
+
+    def _forget_clear_shot(self, key):
+        del self.clear_shots[key]
+
+        for cell in self.clear_shots_cells.pop(key):
+            self.cells_to_clear_shots[cell].discard(key)
+
+
+def assert_routing_cache_is_up_to_date(routing_cache):
+    """
+    Checks that a routing cache kept up to date by blocking and unblocking cells gives the same results as a routing
+    cache built from scratch on the warehouse as it is now.
+    """
+    fresh_routing_cache = RoutingCache(copy.deepcopy(routing_cache.gt_library_warehouse))
+
+    G_library, fresh_G_library = routing_cache.G_library, fresh_routing_cache.G_library
+    assert list(G_library.nodes) == list(fresh_G_library.nodes) and \
+        all(list(G_library.successors(cell)) == list(fresh_G_library.successors(cell)) for cell in G_library.nodes), \
+        'The navigation graph is out of date.'
+
+    for source_cell, distance_row in routing_cache.distance_rows.items():
+        assert distance_row == fresh_routing_cache.get_distance_row(source_cell), \
+            'Distances from %s are out of date.' % (source_cell,)
+
+    for source_cell, predecessor_row in routing_cache.predecessor_rows.items():
+        fresh_routing_cache.get_distance_row(source_cell)
+        assert predecessor_row == fresh_routing_cache.predecessor_rows[source_cell], \
+            'Shortest path tree from %s is out of date.' % (source_cell,)
+
+    for key in list(routing_cache.legs):
+        assert routing_cache.get_leg(*key) == fresh_routing_cache.get_leg(*key), 'Leg %s is out of date.' % (key,)
+
+
+if __name__ == '__main__':
+    # Blocks and unblocks random cells, checking the routing cache against a fresh one after every change
+    np.random.seed(1)
+
+    gt_library_warehouse = utils.get_warehouse('warehouse.json')
+    routing_cache = RoutingCache(gt_library_warehouse)
+
+    pick_faces = sorted(set(utils.get_navigable_cell_coordinate_near_book(location, gt_library_warehouse)
+                            for location in gt_library_warehouse.locations_to_shelve_tags))
+    locations = sorted(gt_library_warehouse.locations_to_shelve_tags)
+
+    for i in np.random.choice(len(locations), size=(20, 2)):
+        routing_cache.get_leg(*[locations[j] for j in i])
+
+    for _ in range(30):
+        if routing_cache.blocked_cells and np.random.rand() < 0.4:
+            blocked_cells = sorted(routing_cache.blocked_cells)
+            routing_cache.unblock_cell(blocked_cells[np.random.randint(len(blocked_cells))])
+        else:
+            # Leave pick faces open so that every cached leg stays routable
+            navigable_cells = sorted(set(routing_cache.G_library.nodes) - set(pick_faces))
+            routing_cache.block_cell(navigable_cells[np.random.randint(len(navigable_cells))])
+
+        assert_routing_cache_is_up_to_date(routing_cache)
+
+    logger.info('Routing cache stayed up to date.')
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import logging
+import threading
+import numbers
+import collections
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+import numpy as np
+import main
+import utils
+from constants import NAVIGABLE_CELL
+
+logger = logging.getLogger(os.path.basename(__file__))
+logger = utils.configure_logger(logger, logging_level=logging.INFO)
+
+# The number of most recent request latencies the reported percentiles are computed over
+LATENCY_WINDOW_SIZE = 1000
+
+
+class PendingSolve(object):
+    """ A solve that concurrent requests for the same pick path wait on together. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.pick_path_as_dict = None
+        self.error = None
+
+
+class PickPathService(object):
+    """
+    Keeps a warehouse loaded and solves pick paths for it in worker processes, each with its own warm routing cache
+    and tour cache. Every pick list (by source and pick faces) is always solved by the same worker, so repeated pick
+    lists see the same tour cache. Concurrent requests for the same books from the same source share a single solve,
+    and repeated or similar pick lists are answered from the tour cache without an exact solve.
+    """
+
+    def __init__(self, gt_library_warehouse, number_of_processes=None):
+        self.gt_library_warehouse = gt_library_warehouse
+        self.tags_to_books = {book.tag: book for book in gt_library_warehouse.books}
+
+        # One single-process pool per worker, so that a pick list can be sent to the worker that owns it
+        self.pools = [multiprocessing.Pool(1, main.initialize_tour_solver, (gt_library_warehouse, True))
+                      for _ in range(number_of_processes or multiprocessing.cpu_count())]
+
+        # Maps a (book tags, source) key to the pending solve of that request
+        self.pending_solves = {}
+        self.pending_solves_lock = threading.Lock()
+
+        self.latencies_ms = collections.deque(maxlen=LATENCY_WINDOW_SIZE)
+        self.number_of_coalesced_requests = 0
+
+    def get_pick_path_as_dict(self, book_tags, source):
+        """ Returns the pick path dictionary for the books with the given tags, starting and ending at the source. """
+        started_at = time.time()
+
+        # Bad requests are turned down here, before they can fail an assertion in a worker process
+        if not isinstance(book_tags, list) or not book_tags \
+                or not all(isinstance(tag, basestring) for tag in book_tags):
+            raise ValueError('Expected a non-empty list of book tags.')
+
+        unknown_book_tags = [tag for tag in book_tags if tag not in self.tags_to_books]
+        if unknown_book_tags:
+            raise ValueError('Unknown book tags %s.' % ', '.join(unknown_book_tags))
+
+        if not self.is_navigable_cell(source):
+            raise ValueError('Source %s is not a navigable [row, column] cell.' % json.dumps(source))
+
+        book_tags = tuple(sorted(set(book_tags)))
+        source = tuple(source)
+        key = book_tags, source
+
+        with self.pending_solves_lock:
+            pending_solve = self.pending_solves.get(key)
+            is_first_request = pending_solve is None
+
+            if is_first_request:
+                pending_solve = self.pending_solves[key] = PendingSolve()
+            else:
+                self.number_of_coalesced_requests += 1
+
+        if is_first_request:
+            books = [self.tags_to_books[tag] for tag in book_tags]
+
+            # Tours are cached by pick faces, so books sharing pick faces go to the same worker too
+            pick_faces = frozenset(tuple(location) for location in self.gt_library_warehouse.get_books_locations(books))
+            pool = self.pools[hash((source, pick_faces)) % len(self.pools)]
+
+            try:
+                pending_solve.pick_path_as_dict = pool.apply(main.solve_tour, ((source, books),))
+            except Exception as e:
+                pending_solve.error = e
+            finally:
+                with self.pending_solves_lock:
+                    del self.pending_solves[key]
+
+                pending_solve.done.set()
+
+        else:
+            pending_solve.done.wait()
+
+        if pending_solve.error is not None:
+            raise pending_solve.error
+
+        pick_path_as_dict = pending_solve.pick_path_as_dict
+
+        self.latencies_ms.append((time.time() - started_at) * 1000)
+
+        return pick_path_as_dict
+
+    def is_navigable_cell(self, cell):
+        """ Returns whether the given value is a (row, column) pair naming a navigable cell of the warehouse. """
+        if not isinstance(cell, (list, tuple)) or len(cell) != 2:
+            return False
+
+        if not all(isinstance(i, numbers.Integral) for i in cell):
+            return False
+
+        r, c = cell
+        return 0 <= r < self.gt_library_warehouse.num_rows and 0 <= c < self.gt_library_warehouse.num_cols \
+            and self.gt_library_warehouse.get_cell(r, c) is NAVIGABLE_CELL
+
+    def get_stats(self):
+        """ Returns the latency percentiles, in milliseconds, over the most recent requests. """
+        latencies_ms = list(self.latencies_ms)
+
+        stats = {
+            'numberOfRequests': len(latencies_ms),
+            'numberOfCoalescedRequests': self.number_of_coalesced_requests,
+        }
+
+        for percentile in (50, 90, 99):
+            stats['p%dLatencyMs' % percentile] = np.percentile(latencies_ms, percentile) if latencies_ms else None
+
+        return stats
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+        for pool in self.pools:
+            pool.join()
+
+
+class PickPathRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves `POST /pick-path` with a JSON body like {"bookTags": ["D-A-100-A", ...], "source": [0, 0]}, which
+    responds with the pick path dictionary, and `GET /stats`, which responds with the latency percentiles.
+    """
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._send_json(404, {'error': 'Unknown path %s.' % self.path})
+
+        self._send_json(200, self.server.pick_path_service.get_stats())
+
+    def do_POST(self):
+        if self.path != '/pick-path':
+            return self._send_json(404, {'error': 'Unknown path %s.' % self.path})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            book_tags, source = request['bookTags'], request['source']
+        except (ValueError, KeyError, TypeError):
+            return self._send_json(400, {'error': 'Expected a JSON body with bookTags and source.'})
+
+        try:
+            pick_path_as_dict = self.server.pick_path_service.get_pick_path_as_dict(book_tags, source)
+        except ValueError as e:
+            return self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            logger.exception('Failed to solve pick path.')
+            return self._send_json(500, {'error': str(e)})
+
+        self._send_json(200, pick_path_as_dict)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PickPathHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, pick_path_service):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, PickPathRequestHandler)
+        self.pick_path_service = pick_path_service
+
+
+if __name__ == '__main__':
+    pick_path_service = PickPathService(utils.get_warehouse('warehouse.json'))
+    server = PickPathHTTPServer(('127.0.0.1', 8000), pick_path_service)
+
+    logger.info('Serving pick paths on http://%s:%d.' % server.server_address)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pick_path_service.close()
@@ -0,0 +1,134 @@
+import os
+import logging
+import collections
+import networkx as nx
+import numpy as np
+import rerouting
+import utils
+from tsp import held_karp as tsp_help_karp
+
+logger = logging.getLogger(os.path.basename(__file__))
+logger = utils.configure_logger(logger)
+
+
+class CachedTour(object):
+    def __init__(self, source, pick_faces, tour, cost, is_optimal):
+        self.source = source
+        self.pick_faces = pick_faces  # type: frozenset
+        self.tour = tour  # type: tuple
+        self.cost = cost
+        self.is_optimal = is_optimal
+
+
+class TourCache(object):
+    """
+    Remembers solved tours by their source and set of pick faces. A new pick list that exactly matches a tour proven
+    optimal reuses it outright, and one sharing at least `min_similarity` of its pick faces (by Jaccard similarity)
+    with a cached tour is warm-started from that tour instead of being solved exactly.
+    """
+
+    def __init__(self, min_similarity=0.5, max_number_of_tours=10000):
+        self.min_similarity = min_similarity
+        self.max_number_of_tours = max_number_of_tours
+
+        # Maps a (source, pick faces) key to its cached tour, oldest first
+        self.tours = collections.OrderedDict()
+
+        # Maps a (source, pick face) pair to the keys of the cached tours visiting that pick face from that source
+        self.pick_faces_to_keys = collections.defaultdict(set)
+
+    def get_tour(self, source, pick_faces):
+        """ Returns the cached tour for exactly these pick faces from this source, or None. """
+        return self.tours.get((source, frozenset(pick_faces)))
+
+    def get_most_similar_tour(self, source, pick_faces):
+        """ Returns the cached tour from this source whose pick faces are most similar to the given ones, or None. """
+        pick_faces = frozenset(pick_faces)
+
+        # Only tours sharing at least one pick face can be similar, so count shared pick faces through the index
+        number_of_shared_pick_faces = collections.Counter()
+        for pick_face in pick_faces:
+            number_of_shared_pick_faces.update(self.pick_faces_to_keys.get((source, pick_face), ()))
+
+        best_similarity, best_tour = 0.0, None
+        for key, number_shared in number_of_shared_pick_faces.items():
+            cached_tour = self.tours[key]
+            similarity = number_shared / float(len(pick_faces) + len(cached_tour.pick_faces) - number_shared)
+
+            if similarity > best_similarity:
+                best_similarity, best_tour = similarity, cached_tour
+
+        if best_similarity < self.min_similarity:
+            return None
+
+        return best_tour
+
+    def add_tour(self, source, pick_faces, tour, cost, is_optimal):
+        """
+        Caches a tour, unless a tour proven optimal, or a heuristic one at least as short as this heuristic tour, is
+        already cached for the same pick faces.
+        """
+        key = source, frozenset(pick_faces)
+
+        cached_tour = self.tours.get(key)
+        if cached_tour is not None and (cached_tour.is_optimal or (not is_optimal and cached_tour.cost <= cost)):
+            return
+
+        self.tours[key] = CachedTour(source, key[1], tour, cost, is_optimal)
+        for pick_face in key[1]:
+            self.pick_faces_to_keys[(source, pick_face)].add(key)
+
+        while len(self.tours) > self.max_number_of_tours:
+            self._forget_tour(next(iter(self.tours)))
+
+    def _forget_tour(self, key):
+        cached_tour = self.tours.pop(key)
+
+        for pick_face in cached_tour.pick_faces:
+            self.pick_faces_to_keys[(cached_tour.source, pick_face)].discard(key)
+
+
+def solve(G_subgraph, source, tour_cache=None):
+    """
+    Solves the TSP on the sub-graph like tsp.held_karp.solver, returning the tour (starting and ending at the source)
+    and its cost. With a tour cache, exact solves are skipped for pick faces whose optimal tour is already cached, and
+    new pick lists similar to a cached one are warm-started from it and improved with 2-opt instead. A pick list that
+    was warm-started before is solved exactly when it comes back, so repeated pick lists end up with optimal tours.
+    """
+    if tour_cache is None:
+        return tsp_help_karp.solver(G_subgraph, source)
+
+    pick_faces = frozenset(G_subgraph.nodes) - {source}
+
+    cached_tour = tour_cache.get_tour(source, pick_faces)
+    if cached_tour is not None and cached_tour.is_optimal:
+        logger.debug('Reusing optimal cached tour.')
+        return cached_tour.tour, cached_tour.cost
+
+    # Warm-starting a pick list from its own heuristic tour would only find that tour again
+    similar_tour = tour_cache.get_most_similar_tour(source, pick_faces) if cached_tour is None else None
+    if similar_tour is None:
+        tour, cost = tsp_help_karp.solver(G_subgraph, source)
+        tour_cache.add_tour(source, pick_faces, tour, cost, is_optimal=True)
+        return tour, cost
+
+    logger.debug('Warm-starting tour from a cached tour on %d pick faces.' % len(similar_tour.pick_faces))
+
+    # Keep the cached tour's order for the shared pick faces, then put in the missing ones where they cost the least
+    distances = {n1: {n2: edges[0]['weight'] for n2, edges in neighbors.items()}
+                 for n1, neighbors in nx.to_dict_of_dicts(G_subgraph).items()}
+
+    def get_distance(location_a, location_b):
+        return 0 if location_a == location_b else distances[location_a][location_b]
+
+    tour = [source] + [pick_face for pick_face in similar_tour.tour[1:-1] if pick_face in pick_faces] + [source]
+    for pick_face in pick_faces - set(tour):
+        tour.insert(rerouting.get_cheapest_insertion_index(get_distance, tour, pick_face) + 1, pick_face)
+
+    distance_matrix = np.array([[get_distance(a, b) for b in tour] for a in tour])
+    tour = tuple([source] + [tour[i + 1] for i in rerouting.improve_path_with_two_opt(distance_matrix)] + [source])
+    cost = sum(get_distance(tour[i], tour[i + 1]) for i in range(len(tour) - 1))
+
+    tour_cache.add_tour(source, pick_faces, tour, cost, is_optimal=False)
+
+    return tour, cost
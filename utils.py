@@ -1,11 +1,15 @@
 import json
 import os
+import collections
 import logging
 import networkx as nx
+import numpy as np
 import itertools
 from constants import NAVIGABLE_CELL, SHELVE_CELL
 from models import GTLibraryGridWarehouse
 import inspect
+import resource
+import time
 
 WAREHOUSE_JSON_FILE_FORMAT_VERSION = '1.1'
 
@@ -36,6 +40,13 @@ logger = logging.getLogger(os.path.basename(__file__))
 logger = configure_logger(logger)
 
 
+def get_peak_memory_usage_mb():
+    """ Returns the peak resident set size of this process and of its largest finished child process, in megabytes. """
+    # Linux reports the maximum resident set size in kilobytes
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0)
+
+
 def get_warehouse(warehouse_file_path):
     """ Loads the given JSON file and returns a GTLibraryGridWarehouse instance. """
 
@@ -68,8 +79,16 @@ def convert_grid_to_graph(gt_library_grid, unit_cost=1):
 
             G.add_node((r, c))
 
-    for n1, n2 in itertools.combinations(G.nodes, 2):
-        if are_neighbors_in_grid(n1, n2):
+    # Connect every pair of neighbors in the order itertools.combinations(G.nodes, 2) would visit them, so that the
+    # graph (and how Dijkstra's algorithm breaks ties on it) only depends on the grid, without checking every pair
+    positions = {node: i for i, node in enumerate(G.nodes)}
+
+    for n1 in G.nodes:
+        r, c = n1
+        later_neighbors = sorted((n2 for n2 in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1))
+                                  if positions.get(n2, -1) > positions[n1]), key=positions.get)
+
+        for n2 in later_neighbors:
             G.add_edge(n1, n2, weight=unit_cost)
             G.add_edge(n2, n1, weight=unit_cost)
 
@@ -93,6 +112,14 @@ def get_navigable_cell_coordinate_near_book(book_coordinate, gt_library_warehous
         return (book_coordinate_r + 1, book_coordinate_c)
 
 
+def get_navigable_cell_coordinate(location, gt_library_warehouse):
+    """ Returns the location itself if it is navigable (e.g. a depot), or the navigable cell next to a book's shelve. """
+    if gt_library_warehouse.get_cell(location[0], location[1]) is NAVIGABLE_CELL:
+        return tuple(location)
+
+    return get_navigable_cell_coordinate_near_book(location, gt_library_warehouse)
+
+
 def are_neighbors_in_grid(coordinate_a, coordinate_b):
     """ Determines if the given cells are neighbors or not. """
     coordinate_a_r, coordinate_a_c = coordinate_a
@@ -107,9 +134,10 @@ def are_neighbors_in_grid(coordinate_a, coordinate_b):
     return False
 
 
-def get_subgraph_on_book_locations(gt_library_warehouse, book_locations, source_location):
+def get_subgraph_on_book_locations(gt_library_warehouse, book_locations, source_location, routing_cache=None):
     """
     Given a list of book locations, this method produces the sub-graph on the navigation grid of these book locations.
+    If a routing cache is given, its precomputed distances are used instead of rebuilding the navigation graph.
     """
 
     # Ensure the source cell is navigable
@@ -121,7 +149,8 @@ def get_subgraph_on_book_locations(gt_library_warehouse, book_locations, source_
         assert gt_library_warehouse.get_cell(book_location_r, book_location_c) is SHELVE_CELL, \
             "Book must be on a shelve."
 
-    G_library = convert_grid_to_graph(gt_library_warehouse.navigation_grid)
+    if routing_cache is None:
+        G_library = convert_grid_to_graph(gt_library_warehouse.navigation_grid)
 
     G_subgraph = nx.MultiDiGraph()
     G_subgraph.add_node(source_location)
@@ -139,8 +168,11 @@ def get_subgraph_on_book_locations(gt_library_warehouse, book_locations, source_
         else:
             cell2_location = get_navigable_cell_coordinate_near_book(location2, gt_library_warehouse)
 
-        # Use Dijkstra's algorithm to determine the distance between adjacent shelves
-        shortest_path_cost = nx.dijkstra_path_length(G_library, cell1_location, cell2_location)
+        if routing_cache is not None:
+            shortest_path_cost = routing_cache.get_distance(location1, location2)
+        else:
+            # Use Dijkstra's algorithm to determine the distance between adjacent shelves
+            shortest_path_cost = nx.dijkstra_path_length(G_library, cell1_location, cell2_location)
 
         G_subgraph.add_edge(location1, location2, weight=shortest_path_cost)
         G_subgraph.add_edge(location2, location1, weight=shortest_path_cost)
@@ -148,10 +180,11 @@ def get_subgraph_on_book_locations(gt_library_warehouse, book_locations, source_
     return G_subgraph
 
 
-def get_pick_path_in_library(gt_library_warehouse, optimal_pick_path_locations, source_coordinate):
+def get_pick_path_in_library(gt_library_warehouse, optimal_pick_path_locations, source_coordinate, routing_cache=None):
     """ Given the TSP shelve locations, this method returns the actual cell-by-cell pick path in the warehouse. """
 
-    G_library = convert_grid_to_graph(gt_library_warehouse.navigation_grid)
+    if routing_cache is None:
+        G_library = convert_grid_to_graph(gt_library_warehouse.navigation_grid)
 
     optimal_pick_path_in_library = []
 
@@ -160,34 +193,66 @@ def get_pick_path_in_library(gt_library_warehouse, optimal_pick_path_locations,
         n1 = optimal_pick_path_locations[i]
         n2 = optimal_pick_path_locations[i + 1]
 
-        if n1 == source_coordinate:
-            c1 = source_coordinate
+        if n1 == n2:
+            # Consecutive books on the same shelve column share a pick face, so there's nothing to route or shortcut
+            path = get_zero_length_leg_in_library(gt_library_warehouse, n1)
+        elif routing_cache is not None:
+            path = routing_cache.get_leg(n1, n2)
         else:
-            c1 = get_navigable_cell_coordinate_near_book(n1, gt_library_warehouse)
+            path = get_leg_in_library(gt_library_warehouse, G_library, n1, n2)
 
-        if n2 == source_coordinate:
-            c2 = source_coordinate
-        else:
-            c2 = get_navigable_cell_coordinate_near_book(n2, gt_library_warehouse)
+        optimal_pick_path_in_library.append(path)
 
-        # Use dijkstra's algorithm to get the best path in the library
-        path = nx.dijkstra_path(G_library, c1, c2)
+    return optimal_pick_path_in_library
 
-        if n1 != source_coordinate:
-            path = [n1] + path
 
-        if n2 != source_coordinate:
-            path = path + [n2]
+def get_leg_in_library(gt_library_warehouse, G_library, location_a, location_b):
+    """ Returns the shortcut cell-by-cell path between two locations, each either a shelve or a navigable cell. """
+    path = get_cell_by_cell_leg_in_library(gt_library_warehouse, G_library, location_a, location_b)
 
-        optimal_pick_path_in_library.append(path)
+    return shortcut_paths(gt_library_warehouse, path)
 
-    for i in range(len(optimal_pick_path_in_library)):
-        optimal_pick_path_in_library[i] = shortcut_paths(gt_library_warehouse, optimal_pick_path_in_library[i])
 
-    return optimal_pick_path_in_library
+def get_zero_length_leg_in_library(gt_library_warehouse, location):
+    """ Returns the leg from a location back to itself, exactly as get_leg_in_library would route and shortcut it. """
+    location = tuple(location)
+    cell = get_navigable_cell_coordinate(location, gt_library_warehouse)
+
+    if cell == location:
+        return [cell, cell]
+
+    return [location, cell, cell, location]
+
+
+def get_cell_by_cell_leg_in_library(gt_library_warehouse, G_library, location_a, location_b):
+    """ Returns the shortest cell-by-cell path between two locations, each either a shelve or a navigable cell. """
+    location_a, location_b = tuple(location_a), tuple(location_b)
+
+    c1 = get_navigable_cell_coordinate(location_a, gt_library_warehouse)
+    c2 = get_navigable_cell_coordinate(location_b, gt_library_warehouse)
+
+    # Use dijkstra's algorithm to get the best path in the library
+    path = nx.dijkstra_path(G_library, c1, c2)
+
+    if c1 != location_a:
+        path = [location_a] + path
 
+    if c2 != location_b:
+        path = path + [location_b]
+
+    return path
+
+
+def shortcut_paths(gt_library_warehouse, cell_by_cell_book_to_book_path, routing_cache=None, deadline=None):
+    """
+    Replaces runs of cells with straight clear shots. Past the optional deadline (a time.time() value), the rest of the
+    path is kept cell by cell, which is just as long to walk but has no further shortcuts.
+    """
+    if routing_cache is not None:
+        is_clear_shot = routing_cache.is_clear_shot
+    else:
+        is_clear_shot = gt_library_warehouse.is_clear_shot
 
-def shortcut_paths(gt_library_warehouse, cell_by_cell_book_to_book_path):
     logger.debug('Shortcutting path with %d cells.' % len(cell_by_cell_book_to_book_path))
 
     shortcut_path = []
@@ -200,12 +265,12 @@ def shortcut_paths(gt_library_warehouse, cell_by_cell_book_to_book_path):
         j = i
         farthest_clear_shot_index = i
 
-        while j < len(cell_by_cell_navigable_path):
+        while j < len(cell_by_cell_navigable_path) and (deadline is None or time.time() < deadline):
 
             current_cell = cell_by_cell_navigable_path[i]
             proposed_shortcut_cell = cell_by_cell_navigable_path[j]
 
-            if gt_library_warehouse.is_clear_shot(current_cell, proposed_shortcut_cell):
+            if is_clear_shot(current_cell, proposed_shortcut_cell):
                 farthest_clear_shot_index = j
 
             j += 1
@@ -221,18 +286,25 @@ def shortcut_paths(gt_library_warehouse, cell_by_cell_book_to_book_path):
     return shortcut_path
 
 
-def reintroduce_duplicate_column_locations(books_and_locations, source, optimal_pick_path):
-    locations_to_books = {source: []}
-    for book, location in books_and_locations:
-        if location not in locations_to_books:
-            locations_to_books[location] = []
-        locations_to_books[location].append(book)
+def get_books_by_pick_face(books, book_locations):
+    """
+    Groups books by the shelve location they are picked from, keeping the order in which locations first appear.
+    Books on the same shelve column share one pick face, so each location only needs to be solved and routed once.
+    """
+    books_by_pick_face = collections.OrderedDict()
+
+    for book, location in zip(books, book_locations):
+        books_by_pick_face.setdefault(tuple(location), []).append(book)
+
+    return books_by_pick_face
+
 
+def reintroduce_duplicate_column_locations(books_by_pick_face, source, optimal_pick_path):
     books = [None]
     new_path = [source]
     for location in optimal_pick_path:
         # Introduce the location to the new path for how many ever copies of the location are in the path
-        for book in locations_to_books[location]:
+        for book in books_by_pick_face.get(location, []):
             books.append(book)
             new_path.append(location)
 
@@ -261,14 +333,7 @@ def assert_library_pick_path_is_proper(optimal_pick_path_in_library, optimal_pic
 
 
 def assert_library_pick_path_has_cost(optimal_library_pick_path, expected_cost, number_of_books):
-    actual_cost = 0
-    # Ensure every step is one cell away
-    for pick_path in optimal_library_pick_path:
-        for i in range(len(pick_path) - 1):
-            curr_x, curr_y = pick_path[i]
-            next_x, next_y = pick_path[i + 1]
-
-            actual_cost += distance((curr_x, curr_y), (next_x, next_y))
+    actual_cost = sum(get_segment_lengths(pick_path).sum() for pick_path in optimal_library_pick_path)
 
     # Every book adds two extra steps (move to book cell, move away from book cell)
     actual_cost -= number_of_books * 2
@@ -311,29 +376,30 @@ def get_shelve_aisle_from_tag(shelve_tag):
     return shelve_tag[2]
 
 
-def distance(p1, p2):
-    return (((p2[0] - p1[0]) ** 2) + ((p2[1] - p1[1]) ** 2)) ** 0.5
-
-
-def dotProduct(p1, p2):
-    return (p1[0] * p2[0]) + (p1[1] * p2[1])
-
-
-# Return minimum distance between line segment and point
-def minimumDistance(line, point):
-    d2 = distance(line[1], line[0]) ** 2.0
-    if d2 == 0.0:
-        return distance(point, line[0])
-    # Consider the line extending the segment, parameterized as line[0] + t (line[1] - line[0]).
-    # We find projection of point p onto the line.
-    # It falls where t = [(point-line[0]) . (line[1]-line[0])] / |line[1]-line[0]|^2
-    p1 = (point[0] - line[0][0], point[1] - line[0][1])
-    p2 = (line[1][0] - line[0][0], line[1][1] - line[0][1])
-    t = dotProduct(p1, p2) / d2  # numpy.dot(p1, p2) / d2
-    if t < 0.0:
-        return distance(point, line[0])  # Beyond the line[0] end of the segment
-    elif t > 1.0:
-        return distance(point, line[1])  # Beyond the line[1] end of the segment
-    p3 = (line[0][0] + (t * (line[1][0] - line[0][0])),
-          line[0][1] + (t * (line[1][1] - line[0][1])))  # projection falls on the segment
-    return distance(point, p3)
+def get_segment_lengths(polyline):
+    """ Returns the length of every segment of the polyline, given as a sequence of (r, c) points. """
+    points = np.asarray(polyline, dtype=float).reshape(-1, 2)
+    return np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+
+
+def get_minimum_distances(segments, points):
+    """
+    Returns the minimum distance between every line segment and every point, as an array with a row for each segment and
+    a column for each point. Segments are given as ((r1, c1), (r2, c2)) pairs and points as (r, c) pairs.
+    """
+    segments = np.asarray(segments, dtype=float).reshape(-1, 2, 2)
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+    starts = segments[:, 0, np.newaxis, :]
+    directions = (segments[:, 1, :] - segments[:, 0, :])[:, np.newaxis, :]
+    squared_lengths = (directions ** 2).sum(axis=2)
+
+    # Project every point onto every segment's line, parameterized as start + t (end - start), and clamp t to the
+    # segment. Zero-length segments project every point onto their start.
+    dot_products = ((points[np.newaxis, :, :] - starts) * directions).sum(axis=2)
+    t = np.divide(dot_products, squared_lengths, out=np.zeros_like(dot_products), where=squared_lengths != 0.0)
+    t = np.clip(t, 0.0, 1.0)
+
+    projections = starts + t[:, :, np.newaxis] * directions
+
+    return np.sqrt(((points[np.newaxis, :, :] - projections) ** 2).sum(axis=2))